@@ -4,7 +4,9 @@ import getopt
 import sys
 import re
 
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import time
 import signal
 import shutil
 import os
@@ -14,13 +16,51 @@ import enum
 import jsonpickle
 import math
 import cv2
+import numpy as np
+
+try:
+    # optional: JIT the residual DB scan, LLVM recognizes the Kernighan
+    # loop as ctpop and lowers it to a single popcnt per hash
+    from numba import njit
+
+    @njit(cache=True, boundscheck=False)
+    def anySimilar(hashes, hash, threshold):
+        one = np.uint64(1)
+        for i in range(hashes.size):
+            x = hashes[i] ^ hash
+            c = 0
+            while x:
+                x &= x - one
+                c += 1
+            if c < threshold:
+                return True
+        return False
+except ImportError:
+    anySimilar = None
 
 logLevel = logging.INFO
 # logLevel = logging.DEBUG
 
+logLevelNames = {
+    logging.DEBUG: "DEBUG",
+    logging.INFO: "INFO",
+    logging.ERROR: "ERROR",
+}
+
 Operations = enum.Enum('Operations', ('CutVideoFile',
                        'BuildHashDB', 'AppendToHashDB', "Error"))
 
+# shared across the worker pool so Ctrl+C reaches in-flight scans,
+# a bool on Configs would be frozen into each pickled task
+cancelEvent = multiprocessing.Event()
+
+
+def initWorker(event):
+    # workers poll the parent's event instead of handling SIGINT themselves
+    global cancelEvent
+    cancelEvent = event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
 
 class Configs:
     __max_hamming_distance = 7
@@ -31,6 +71,9 @@ class Configs:
         self.max_header_length_ms = 5 * 60 * 1000
 
         self.op = Operations.Error
+        self.__log_fp = None
+        self.__log_sec = -1
+        self.__log_sec_str = ""
         self.db = os.environ.get('VTRIM_CONFIG_DB', "./clips.db")
         self.sources = [os.environ.get('VTRIM_CONFIG_SOURCE', "./in/")]
         self.dest = os.environ.get('VTRIM_CONFIG_DEST', "./out/")
@@ -39,99 +82,130 @@ class Configs:
 
         self.exts = None
         self.end = -1
+        self.hash_array = None
+        self.hash_pops = None
         self.__max_hamming_distance = math.ceil(8 * 4 * (1-similarity))
         self.debug("current directory:", os.getcwd())
 
-        self.__closed = False
         signal.signal(signal.SIGINT, self.__handle_ctrl_c)
 
     def __handle_ctrl_c(self, _, __):
         self.info('detect Ctrl+C signal.')
         self.info("await pending jobs to finish...")
-        self.__closed = True
+        cancelEvent.set()
 
     def isCancelled(self):
-        return self.__closed
+        return cancelEvent.is_set()
 
     def isSimilar(self, hashes, hash):
         if hash in hashes:
             self.debug("hit hash:", hash)
             return True
 
-        for h in hashes:
-            diff = hamming(h, hash)
-            if diff < self.__max_hamming_distance:
-                self.debug("similar to:", h, "diff:", diff)
-                return True
+        if self.hash_array is not None and len(self.hash_array) > 0:
+            # |popcount(a) - popcount(b)| bounds hamming(a, b) from below,
+            # the DB is sorted by popcount so most of it is skipped here
+            t = self.__max_hamming_distance
+            qp = hash.bit_count()
+            lo = np.searchsorted(self.hash_pops, qp - t + 1, side='left')
+            hi = np.searchsorted(self.hash_pops, qp + t - 1, side='right')
+            if lo < hi:
+                chunk = self.hash_array[lo:hi]
+                if anySimilar is not None:
+                    found = anySimilar(chunk, np.uint64(hash), t)
+                else:
+                    found = bool((hammingAll(chunk, np.uint64(hash)) < t).any())
+                if found:
+                    self.debug("similar hash:", hash)
+                    return True
 
         self.debug("new hash:", hash)
         return False
 
-    def writeToLogFile(self, line):
-        if self.log_file_name != None:
-            with open(self.log_file_name, "a+") as f:
-                f.write(line)
-                f.write("\n")
+    def __getstate__(self):
+        # the cached log handle can not cross process boundaries
+        state = self.__dict__.copy()
+        state['_Configs__log_fp'] = None
+        return state
 
-    def __log(self, level, argv):
-        if level < logLevel:
+    def writeToLogFile(self, line):
+        if self.log_file_name == None:
             return
+        if self.__log_fp is None:
+            self.__log_fp = open(self.log_file_name, "a+")
+        self.__log_fp.write(line)
+        self.__log_fp.write("\n")
+        self.__log_fp.flush()
+
+    def __timestamp(self):
+        # strftime is costly on a per-frame hot path,
+        # reformat the second part only when the second changes
+        now = time.time()
+        sec = int(now)
+        if sec != self.__log_sec:
+            self.__log_sec = sec
+            self.__log_sec_str = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(sec))
+        return f"{self.__log_sec_str},{int((now - sec) * 1000000):06d}"
 
-        t = datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")
-        l = logging.getLevelName(level)
+    def __log(self, level, argv):
+        l = logLevelNames.get(level) or logging.getLevelName(level)
         msg = ' '.join(map(str, argv))
-        line = f"{t} [{l}] {msg}"
+        line = f"{self.__timestamp()} [{l}] {msg}"
         print(line)
-        if self.log_file_name != None:
-            with open(self.log_file_name, "a+") as f:
-                f.write(line)
-                f.write("\n")
+        self.writeToLogFile(line)
 
     def debug(self, *argv):
-        self.__log(logging.DEBUG, argv)
+        if logLevel <= logging.DEBUG:
+            self.__log(logging.DEBUG, argv)
 
     def info(self, *argv):
-        self.__log(logging.INFO, argv)
+        if logLevel <= logging.INFO:
+            self.__log(logging.INFO, argv)
 
     def error(self, *argv):
-        self.__log(logging.ERROR, argv)
-
-    def clearHashDB(self):
-        with open(self.db, "w"):
-            pass
-
-    def appendHashDB(self, hash):
-        with open(self.db, "a+") as f:
-            f.write(str(hash))
-            f.write("\n")
+        if logLevel <= logging.ERROR:
+            self.__log(logging.ERROR, argv)
 
     def hasValidExtension(self, path):
-        if self.exts == None:
-            return True
-        lower = path.lower()
-        for ext in self.exts:
-            if lower.endswith(ext):
-                return True
-        return False
+        # endswith with a tuple checks all suffixes in one C call
+        return self.exts == None or path.lower().endswith(self.exts)
 
 
 def doCutVideoFiles(cfg: Configs):
-    cfg.debug("cut video with configs:")
-    cfg.debug(jsonpickle.encode(cfg))
+    # jsonpickle walks the whole Configs graph, only pay for it in debug
+    if logLevel <= logging.DEBUG:
+        cfg.debug("cut video with configs:")
+        cfg.debug(jsonpickle.encode(cfg))
 
     if not os.path.isfile(cfg.db):
         cfg.error("db file", f"\"{cfg.db}\"", "not found")
         return 1
 
     hashes = loadHashDB(cfg)
+
+    # each file is independent (read-only hashes, own ffmpeg subprocess),
+    # so decode and cut of different files overlap across cores
+    workers = max(1, (os.cpu_count() or 2) // 2)
     success, fail = 0, 0
-    for source in cfg.sources:
-        if cfg.isCancelled():
-            break
-        for src in getAllVideoFiles(cfg, source):
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=initWorker,
+                             initargs=(cancelEvent,)) as executor:
+        futures = []
+        for source in cfg.sources:
             if cfg.isCancelled():
                 break
-            if processVideoFile(cfg, hashes, src):
+            for src in getAllVideoFiles(cfg, source):
+                if cfg.isCancelled():
+                    break
+                futures.append(
+                    executor.submit(processVideoFile, cfg, hashes, src))
+        for future in futures:
+            # on Ctrl+C drop the queued files, in-flight scans see the
+            # shared event inside findCutPoint and wind down on their own
+            if cfg.isCancelled() and future.cancel():
+                continue
+            if future.result():
                 success += 1
             else:
                 fail += 1
@@ -139,15 +213,31 @@ def doCutVideoFiles(cfg: Configs):
     return 0
 
 
+def openVideo(src):
+    # VTRIM_CONFIG_LOWRES=n asks FFmpeg to decode at 1/2^n resolution,
+    # pHash only needs 32x32 anyway; opt-in because not every codec
+    # supports the lowres flag
+    lowres = os.environ.get('VTRIM_CONFIG_LOWRES')
+    if lowres:
+        os.environ.setdefault(
+            'OPENCV_FFMPEG_CAPTURE_OPTIONS', f"lowres;{lowres}")
+    # let FFmpeg pick a hardware decoder (NVDEC/VA-API/...) when one
+    # exists, it silently falls back to software decode otherwise
+    return cv2.VideoCapture(src, cv2.CAP_FFMPEG,
+                            [cv2.CAP_PROP_HW_ACCELERATION,
+                             cv2.VIDEO_ACCELERATION_ANY])
+
+
 def findCutPoint(cfg: Configs, heashes, src):
-    video = cv2.VideoCapture(src)
-    # fps = math.floor(video.get(cv2.CAP_PROP_FPS))
+    video = openVideo(src)
     count, ms, t = 0, 0, 0
     while video.isOpened():
         if cfg.isCancelled():
             ms = -1
             break
-        ok, image = video.read()
+        # grab() only demuxes/decodes, the BGR ndarray is materialized
+        # by retrieve() just for the one frame per second we hash
+        ok = video.grab()
         ms = math.floor(video.get(cv2.CAP_PROP_POS_MSEC))
         if not ok or ms > cfg.max_header_length_ms:
             break
@@ -156,6 +246,9 @@ def findCutPoint(cfg: Configs, heashes, src):
         if ms >= t:
             t += 1000
             cfg.debug("matching frame:", count, "at:", ms, "ms")
+            ok, image = video.retrieve()
+            if not ok:
+                break
             hash = pHash(image)
             if not cfg.isSimilar(heashes, hash):
                 break
@@ -210,9 +303,16 @@ def loadHashDB(cfg):
     if not os.path.isfile(db):
         return r
     cfg.info("loading hash DB:", db)
-    with open(cfg.db, "r") as f:
-        for line in f.readlines():
-            r.add(int(line))
+    if isLegacyTextDB(db):
+        with open(cfg.db, "r") as f:
+            r = set(map(int, f))
+    else:
+        r = set(np.fromfile(db, dtype='<u8').tolist())
+    arr = np.fromiter(r, dtype=np.uint64, count=len(r))
+    pops = hammingAll(arr, np.uint64(0))
+    order = np.argsort(pops, kind='stable')
+    cfg.hash_array = arr[order]
+    cfg.hash_pops = pops[order]
     cfg.info(len(r), "hashes loaded")
     return r
 
@@ -224,7 +324,7 @@ def appendSampleVideoToHashDB(cfg, db, src, max):
 
     cfg.info("analyzing file:", src)
     count, n = 0, 0
-    video = cv2.VideoCapture(src)
+    video = openVideo(src)
     while video.isOpened():
         count += 1
         ok, image = video.read()
@@ -242,18 +342,15 @@ def appendSampleVideoToHashDB(cfg, db, src, max):
 
 
 def getAllVideoFiles(cfg: Configs, path):
-    r = []
     if os.path.isfile(path):
         if cfg.hasValidExtension(path):
-            r.append(path)
-        return r
+            yield path
+        return
 
     for currentpath, folders, files in os.walk(path):
         for file in files:
             if cfg.hasValidExtension(file):
-                fullpath = os.path.join(currentpath, file)
-                r.append(fullpath)
-    return r
+                yield os.path.join(currentpath, file)
 
 
 def doAppendHash(cfg):
@@ -261,8 +358,9 @@ def doAppendHash(cfg):
     if not confirmOptions(cfg):
         return 1
 
-    cfg.debug("add hash to db with configs:")
-    cfg.debug(jsonpickle.encode(cfg))
+    if logLevel <= logging.DEBUG:
+        cfg.debug("add hash to db with configs:")
+        cfg.debug(jsonpickle.encode(cfg))
 
     if cfg.op == Operations.AppendToHashDB and cfg.end < 1:
         cfg.error("-t must bigger than zero")
@@ -282,21 +380,37 @@ def doAppendHash(cfg):
     return 0
 
 
+def isLegacyTextDB(path):
+    # DBs written before the binary format were ASCII decimal lines
+    with open(path, "rb") as f:
+        head = f.read(4096)
+    return len(head) > 0 and head.translate(None, b"0123456789\r\n") == b""
+
+
 def writeHashDB(cfg, db):
     cfg.info("write", len(db), "hashes:", cfg.db)
-    cfg.clearHashDB()
-    for hash in db:
-        cfg.appendHashDB(hash)
+    np.asarray(sorted(db), dtype='<u8').tofile(cfg.db)
 
 
-def hamming(a, b):
-    return bin(a ^ b).count('1')
+def hammingAll(hashes, hash):
+    # branchless SWAR popcount, broadcast by NumPy across the whole DB
+    x = hashes ^ hash
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + \
+        ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
 
 
 def pHash(cv_image):
-    imgsm = cv2.resize(cv_image, (320, 320), interpolation=cv2.INTER_CUBIC)
+    # INTER_AREA straight to the 32x32 gray image pHash works on,
+    # the old 320x320 INTER_CUBIC pass was recomputed away by pHash anyway.
+    # going through UMat lets the T-API reuse device buffers between
+    # frames instead of allocating fresh ndarrays per call
+    umat = cv2.UMat(cv_image)
+    imgsm = cv2.resize(umat, (32, 32), interpolation=cv2.INTER_AREA)
     imgg = cv2.cvtColor(imgsm, cv2.COLOR_BGR2GRAY)
-    hash = cv2.img_hash.pHash(imgg)  # 8-byte hash
+    hash = cv2.img_hash.pHash(imgg.get())  # 8-byte hash
     ph = int.from_bytes(hash.tobytes(), byteorder='big', signed=False)
     return ph
 
@@ -392,8 +506,8 @@ def parseCmdOptions():
             elif key in ("-d", "--db"):
                 configs.db = value
             elif key in ("-e", "--ext"):
-                configs.exts = set(
-                    ["." + x for x in re.split(r' |,|\.', value.lower()) if x])
+                configs.exts = tuple(
+                    "." + x for x in re.split(r' |,|\.', value.lower()) if x)
             elif key in ("-m", "--move"):
                 configs.move_file_after_cut = True
             elif key in ("-l", "--log"):
@@ -420,4 +534,5 @@ def parseCmdOptions():
     return configs
 
 
-exit(main())
+if __name__ == "__main__":
+    exit(main())
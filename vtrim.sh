@@ -4,4 +4,7 @@ export VTRIM_CONFIG_DB="/my/path/to/clips.db"
 export VTRIM_CONFIG_SOURCE="/my/video/folder/"
 export VTRIM_CONFIG_DEST="/my/output/folder/"
 
+# 可选：让解码器按 1/2^n 分辨率输出，加快扫描速度（部分编码格式不支持）
+# export VTRIM_CONFIG_LOWRES="2"
+
 ./vtrim.py "$@"
\ No newline at end of file